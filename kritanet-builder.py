@@ -15,9 +15,12 @@
 #
 
 import argparse
+import asyncio
 import logging
 import subprocess
 import os
+import shutil
+import sys
 
 #
 # Constants
@@ -45,22 +48,77 @@ class KritanetPaths:
         self.dst_root = None
         # Relative paths of all directories in the source Kritanet
         self.src_dirs = []
-        # Relative paths of all cards (.kra) in the source Kritanet
+        # Relative paths, mtimes and sizes of all cards (.kra) in the source Kritanet
         self.src_cards = []
         # Relative paths of all currently present directories in the destination Kritanet
         self.dst_dirs = []
-        # Relative paths of all currently present cards (.jpg) in the destination Kritanet
+        # Relative paths, mtimes and sizes of all currently present cards (.jpg) in the destination Kritanet
         self.dst_cards = []
 
 #
 # Functions
 #
 
-def convert_file(in_file, out_file):
-    res = subprocess.run(
-        ['krita', in_file, '--export', '--export-filename', out_file],
-        capture_output=True)
-    res.check_returncode()
+# Krita's command line exports exactly one document per invocation and has no
+# option to read further jobs from stdin, so every card costs a full Krita
+# startup. Running conversions in parallel (see convert_cards) overlaps these
+# startups, but does not avoid them.
+async def convert_file(in_file, out_file, krita_bin='krita'):
+    args = [krita_bin, in_file, '--export', '--export-filename', out_file]
+    proc = await asyncio.create_subprocess_exec(*args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE)
+    # Only stderr is kept, to report why a conversion failed
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr)
+
+async def _convert_one(card, sc, dc, krita_bin, sem):
+    async with sem:
+        log.debug(f"Converting: '{sc}' -> '{dc}")
+        try:
+            await convert_file(sc, dc, krita_bin)
+        except subprocess.CalledProcessError as e:
+            return (card, dc, False, e.stderr.decode(errors='replace').strip())
+        except OSError as e:
+            return (card, dc, False, str(e))
+    return (card, dc, True, None)
+
+async def convert_cards(cards_to_make, krita_bin, jobs=None):
+    # At most `jobs` Krita processes run at once; the next one is spawned as
+    # soon as a slot frees up, while progress is reported as results arrive
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    sem = asyncio.Semaphore(jobs)
+    tasks = [
+        asyncio.create_task(_convert_one(card, sc, dc, krita_bin, sem))
+        for card, sc, dc in cards_to_make
+        ]
+
+    cards_made = 0
+    failed = []
+    for task in asyncio.as_completed(tasks):
+        card, dc, ok, stderr = await task
+        cards_made += 1
+
+        percent = 100 * cards_made / len(cards_to_make)
+
+        if ok:
+            log.info(f"{cards_made}/{len(cards_to_make)} ({percent:3.0f}%): {dc}")
+        else:
+            failed.append(card)
+            log.error(f"{cards_made}/{len(cards_to_make)} ({percent:3.0f}%): Failed to convert '{dc}': {stderr}")
+
+    return failed
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a positive integer")
+    return number
 
 def parse_args():
     p = argparse.ArgumentParser(
@@ -72,31 +130,59 @@ def parse_args():
     p.add_argument('-d', '--dest',
         help='Destination directory for output',
         required=True)
+    p.add_argument('-o', '--overwrite',
+        help='Remove the destination directory and rebuild all cards',
+        action='store_true')
+    p.add_argument('-j', '--jobs',
+        help='Number of parallel conversions (default: number of CPUs)',
+        type=positive_int,
+        default=None)
     p.add_argument('-v', '--verbose',
         help='Include debug output',
         action='store_true')
 
     return p.parse_args()
 
+def _walk(root, rel, ext, out_dirs, out_files, out_other=None):
+    log.debug(f"Entering '{rel}'")
+
+    # Like os.walk, directories that cannot be read are skipped
+    dirpath = os.path.join(root, rel)
+    try:
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+    except OSError as e:
+        log.warning(f"Skipping unreadable directory '{dirpath}': {e}")
+        return
+
+    # Relative paths are built by plain concatenation, names coming from
+    # scandir never contain a separator
+    prefix = rel + '/' if rel else ''
+    for entry in entries:
+        entrypath = prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            out_dirs.append(entrypath)
+            _walk(root, entrypath, ext, out_dirs, out_files, out_other)
+        elif entry.is_dir():
+            # Like os.walk, symlinked directories are not followed
+            log.debug(f"Skipping symlinked directory '{entrypath}'")
+        elif entry.is_file() and entry.name.endswith(ext):
+            try:
+                st = entry.stat()
+            except OSError as e:
+                log.warning(f"Skipping unreadable file '{os.path.join(root, entrypath)}': {e}")
+                continue
+            out_files.append((entrypath, st.st_mtime, st.st_size))
+        elif out_other is not None:
+            out_other.append(entrypath)
+
 def walk_src_root(path, kritanet_paths_ref):
     path = path.rstrip('/')
     kritanet_paths_ref.src_root = path
 
     log.debug(f"Walking source root '{path}'")
-    for root, dirs, files in os.walk(path):
-        root = root.rstrip('/')
-        relpath = root.removeprefix(path + '/')
-        log.debug(f"Entering '{relpath}'")
-
-        if root != path:
-            kritanet_paths_ref.src_dirs.append(relpath)
-        else:
-            relpath = ''
-        
-        for file in files:
-            if file.endswith('.kra'):
-                cardpath = os.path.join(relpath, file)
-                kritanet_paths_ref.src_cards.append(cardpath)
+    _walk(path, '', '.kra',
+        kritanet_paths_ref.src_dirs, kritanet_paths_ref.src_cards)
 
 def walk_dst_root(path, kritanet_paths_ref):
     path = path.rstrip('/')
@@ -106,83 +192,92 @@ def walk_dst_root(path, kritanet_paths_ref):
         log.debug(f"Destination root '{path}' does not yet exist")
         return
 
+    with os.scandir(path) as it:
+        if not any(it):
+            log.debug(f"Destination root '{path}' is empty")
+            return
+
     log.debug(f"Walking destination root '{path}'")
-    for root, dirs, files in os.walk(path):
-        root = root.rstrip('/')
-        relpath = root.removeprefix(path + '/')
-        log.debug(f"Entering '{relpath}'")
+    unknown_files = []
+    _walk(path, '', '.jpg',
+        kritanet_paths_ref.dst_dirs, kritanet_paths_ref.dst_cards, unknown_files)
 
-        if root != path:
-            kritanet_paths_ref.dst_dirs.append(relpath)
-        else:
-            relpath = ''
-        
-        for file in files:
-            cardpath = os.path.join(relpath, file)
-            if file.endswith('.jpg'):
-                kritanet_paths_ref.dst_cards.append(cardpath)
-            else:
-                log.warn(f"Unknown file in destination root: '{cardpath}'")
+    for file in unknown_files:
+        log.warning(f"Unknown file in destination root: '{file}'")
 
-def equalise_roots(kritanet_paths):
+def equalise_roots(kritanet_paths, jobs=None):
     # Create copies of collections, that will be modified
-    unaccounted_dst_dirs = [dir for dir in kritanet_paths.dst_dirs]
-    unaccounted_dst_cards = [card for card in kritanet_paths.dst_cards]
+    unaccounted_dst_dirs = set(kritanet_paths.dst_dirs)
+    dst_mtime = {card: mtime for card, mtime, _ in kritanet_paths.dst_cards}
+    unaccounted_dst_cards = set(dst_mtime)
 
     # Equalise directories
 
+    missing_dirs = []
     for src_dir in kritanet_paths.src_dirs:
         if src_dir in unaccounted_dst_dirs:
             log.debug(f"Directory '{src_dir}' already exists")
             unaccounted_dst_dirs.remove(src_dir)
         else:
-            dirpath = os.path.join(kritanet_paths.dst_root, src_dir)
+            missing_dirs.append(src_dir)
+
+    # Only the deepest missing directories are created, os.makedirs creates
+    # their missing parents along the way
+    missing_parents = {os.path.dirname(dir) for dir in missing_dirs}
+    for dir in missing_dirs:
+        if dir not in missing_parents:
+            dirpath = os.path.join(kritanet_paths.dst_root, dir)
             log.debug(f"Creating directory '{dirpath}'")
-            os.makedirs(dirpath)
+            os.makedirs(dirpath, exist_ok=True)
     
     if len(unaccounted_dst_dirs) > 0:
-        log.warning(f"Unaccounted destination directories: {unaccounted_dst_dirs}")
+        log.warning(f"Unaccounted destination directories: {sorted(unaccounted_dst_dirs)}")
     
     # Find exisisting cards
 
     log.debug('Finding existing cards')
+    # Relative source path, absolute source and destination paths of each
+    # card to make, joined once here and passed through to the conversion
     cards_to_make = []
+    src_size = {}
 
-    for card in kritanet_paths.src_cards:
+    for card, src_mtime, size in kritanet_paths.src_cards:
+        src_size[card] = size
         jpg_card = rename_kra_to_jpg(card)
-        sc = os.path.join(kritanet_paths.src_root, card)
         dc = os.path.join(kritanet_paths.dst_root, jpg_card)
-        if jpg_card in unaccounted_dst_cards:
+        if jpg_card in dst_mtime:
             unaccounted_dst_cards.remove(jpg_card)
-            if os.path.getmtime(sc) > os.path.getmtime(dc):
+            if src_mtime > dst_mtime[jpg_card]:
                 log.debug(f"Outdated card: '{dc}'")
-                cards_to_make.append(card)
+                cards_to_make.append((card, os.path.join(kritanet_paths.src_root, card), dc))
             else:
                 log.debug(f"Card '{dc}' is up to date")
         else:
             log.debug(f"Missing card: '{dc}'")
-            cards_to_make.append(card)
+            cards_to_make.append((card, os.path.join(kritanet_paths.src_root, card), dc))
     
+    # Conversion time grows with the size of the Krita file, so the largest
+    # cards are started first and small ones fill the remaining slots
+    cards_to_make.sort(key=lambda c: src_size[c[0]], reverse=True)
+
     if len(cards_to_make) > 0:
-        log.debug(f"Cards to make: {cards_to_make}")
+        log.debug(f"Cards to make: {[card for card, _, _ in cards_to_make]}")
     if len(unaccounted_dst_cards) > 0:
-        log.warning(f"Unaccounted cards: {unaccounted_dst_cards}")
+        log.warning(f"Unaccounted cards: {sorted(unaccounted_dst_cards)}")
     
     # Make new cards
 
-    cards_made = 0
-    for card in cards_to_make:
-        jpg_card = rename_kra_to_jpg(card)
-        sc = os.path.join(kritanet_paths.src_root, card)
-        dc = os.path.join(kritanet_paths.dst_root, jpg_card)
-
-        percent = 100 * cards_made / len(cards_to_make)
+    if len(cards_to_make) == 0:
+        return []
 
-        log.debug(f"Converting: '{sc}' -> '{dc}")
-        log.info(f"{cards_made}/{len(cards_to_make)} ({percent:3.0f}%): {dc}")
-        convert_file(sc, dc)
+    # Resolve Krita once, instead of a $PATH lookup for every conversion
+    krita_bin = shutil.which('krita')
+    if krita_bin is None:
+        log.error("Krita executable 'krita' not found in PATH")
+        return [card for card, _, _ in cards_to_make]
+    log.debug(f"Krita executable: '{krita_bin}'")
 
-        cards_made += 1
+    return asyncio.run(convert_cards(cards_to_make, krita_bin, jobs))
 
 def rename_kra_to_jpg(path):
     return path.removesuffix('.kra') + '.jpg'
@@ -201,6 +296,24 @@ if __name__ == '__main__':
     log.debug(f"Source root: '{args.source}'")
     log.debug(f"Output root: '{args.dest}'")
 
+    if not os.path.isdir(args.source):
+        log.error(f"Source root '{args.source}' is not a directory")
+        sys.exit(1)
+
+    if args.overwrite and os.path.islink(args.dest):
+        log.error(f"Refusing to remove destination root '{args.dest}', it is a symbolic link")
+        sys.exit(1)
+
+    if args.overwrite and os.path.isdir(args.dest):
+        real_src = os.path.realpath(args.source)
+        real_dst = os.path.realpath(args.dest)
+        if os.path.commonpath([real_src, real_dst]) == real_dst:
+            log.error(f"Refusing to remove destination root '{args.dest}', it contains the source root '{args.source}'")
+            sys.exit(1)
+
+        log.info(f"Removing destination root '{args.dest}'")
+        shutil.rmtree(args.dest)
+
     os.makedirs(args.dest, exist_ok=True)
 
     kritanet_paths = KritanetPaths()
@@ -216,5 +329,9 @@ if __name__ == '__main__':
 
     log.info(f"Found {len(kritanet_paths.src_cards)} source and {len(kritanet_paths.dst_cards)} existing cards")
     log.info('Equalising source and destination directories')
-    equalise_roots(kritanet_paths)
-    log.info('Equalising done')
\ No newline at end of file
+    failed_cards = equalise_roots(kritanet_paths, args.jobs)
+    log.info('Equalising done')
+
+    if len(failed_cards) > 0:
+        log.error(f"Failed to convert {len(failed_cards)} cards: {sorted(failed_cards)}")
+        sys.exit(1)